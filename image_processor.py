@@ -1,20 +1,112 @@
 import os
-from huggingface_hub import InferenceClient
+import asyncio
+import backoff
+import httpx
+from huggingface_hub import AsyncInferenceClient
+from huggingface_hub.errors import HfHubHTTPError
 from PIL import Image
 import io
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
 import streamlit as st
-import time
-from typing import Dict
+from typing import Coroutine, Dict, Optional
 
 
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB per file
 SUPPORTED_FORMATS = ['png', 'jpg', 'jpeg', 'webp']
+DEFAULT_CONCURRENCY_LIMIT = 4  # Max in-flight API requests per batch
+MAX_INPUT_EDGE = 1024  # Longest edge sent to the API; larger inputs are downscaled
+THUMBNAIL_WIDTH = 80  # Width of the loaded-file thumbnails
+PREVIEW_WIDTH = 1024  # Width of the before/after previews
+
+# Retry policy for API calls
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+MAX_API_TRIES = 6
+MAX_API_RETRY_TIME = 60  # seconds
+MAX_BACKOFF_WAIT = 32  # seconds
+# What the httpx-based AsyncInferenceClient raises for timeouts and HTTP errors
+TIMEOUT_ERRORS = (httpx.TimeoutException, TimeoutError)
+RETRYABLE_ERRORS = (HfHubHTTPError,) + TIMEOUT_ERRORS
+
+# Edited results cached by (image, prompt) so repeat runs skip the API
+RESULT_CACHE_SIZE = 128
+_result_cache: "OrderedDict[str, bytes]" = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+
+def make_preview(image_bytes: bytes, width: int) -> bytes:
+    """Encode a JPEG at most `width` wide that st.image(output_format="JPEG") sends as-is"""
+    image = Image.open(io.BytesIO(image_bytes))
+    size = (width, max(1, round(image.height * width / image.width)))
+    image.draft('RGB', size)  # Lets JPEG decode at reduced scale
+    
+    # JPEG has no alpha, so flatten transparency onto white like _prepare_image
+    if image.mode in ['RGBA', 'LA', 'P']:
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    
+    if image.width > width:
+        image = image.resize(size, Image.LANCZOS)
+    
+    preview_buffer = io.BytesIO()
+    image.save(preview_buffer, format='JPEG', quality=85)
+    return preview_buffer.getvalue()
+
+def _should_give_up(error: Exception) -> bool:
+    """Only retry timeouts, rate limits and transient server errors"""
+    if isinstance(error, TIMEOUT_ERRORS):
+        return False
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', 0) not in RETRYABLE_STATUS_CODES
+
+def _retry_after_seconds(error: Exception) -> float:
+    """Read the provider's Retry-After hint (in seconds) from an HTTP error"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        retry_after = float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return 0.0
+    return min(max(retry_after, 0.0), MAX_API_RETRY_TIME)
+
+async def _honor_retry_after_async(details: Dict) -> None:
+    """Async backoff handler: wait out the Retry-After hint before the next attempt"""
+    delay = _retry_after_seconds(details['exception'])
+    if delay:
+        await asyncio.sleep(delay)
+
+def _result_cache_key(image_bytes: bytes, prompt: str) -> str:
+    """Build the result cache key from the image content and prompt"""
+    return hashlib.sha256(image_bytes).hexdigest() + ":" + hashlib.sha256(prompt.encode()).hexdigest()
+
+def _get_cached_result(cache_key: str) -> Optional[bytes]:
+    """Return cached result bytes for a key, marking it recently used"""
+    with _result_cache_lock:
+        result_bytes = _result_cache.get(cache_key)
+        if result_bytes is not None:
+            _result_cache.move_to_end(cache_key)
+        return result_bytes
+
+def _store_cached_result(cache_key: str, result_bytes: bytes) -> None:
+    """Cache result bytes, evicting the least recently used entries"""
+    with _result_cache_lock:
+        _result_cache[cache_key] = result_bytes
+        _result_cache.move_to_end(cache_key)
+        while len(_result_cache) > RESULT_CACHE_SIZE:
+            _result_cache.popitem(last=False)
 
 
 
 class ImageProcessor:
     def __init__(self):
-        self.client = None
+        self.aclient = None
+        self._loop = None
         self._initialize_client()
     
     def _initialize_client(self):
@@ -31,41 +123,46 @@ class ImageProcessor:
             st.stop()
         
         try:
-            self.client = InferenceClient(
+            self.aclient = AsyncInferenceClient(
                 provider="fal-ai",
                 api_key=token,
             )
-            # Test the client with a simple call
+            # The client's connection pool is bound to the loop it first runs on,
+            # so one long-lived loop runs every batch and the pool survives them
+            self._loop = asyncio.new_event_loop()
+            threading.Thread(target=self._loop.run_forever, name="inference-loop", daemon=True).start()
             st.success("✅ HuggingFace client initialized successfully")
         except Exception as e:
             st.error(f"❌ Failed to initialize HuggingFace client: {str(e)}")
             st.error("Please check your HF_TOKEN and internet connection.")
             st.stop()
     
-    def validate_image(self, file) -> Dict[str, any]:
-        """Validate uploaded image file with comprehensive checks"""
+    def submit(self, coro: Coroutine) -> Future:
+        """Schedule a coroutine on the processor's event loop from any thread"""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+    
+    def validate_image(self, file_bytes: bytes, filename: str, size: int) -> Dict[str, any]:
+        """Validate uploaded image bytes with comprehensive checks"""
         try:
             # Check file size
-            if file.size > MAX_FILE_SIZE:
+            if size > MAX_FILE_SIZE:
                 return {
                     'valid': False, 
-                    'error': f'File too large: {file.size/1024/1024:.1f}MB (max: {MAX_FILE_SIZE/1024/1024}MB)'
+                    'error': f'File too large: {size/1024/1024:.1f}MB (max: {MAX_FILE_SIZE/1024/1024}MB)'
                 }
             
             # Check file format by extension
-            file_extension = file.name.split('.')[-1].lower() if '.' in file.name else ''
+            file_extension = filename.split('.')[-1].lower() if '.' in filename else ''
             if file_extension not in SUPPORTED_FORMATS:
                 return {
                     'valid': False,
                     'error': f'Unsupported format: {file_extension} (supported: {", ".join(SUPPORTED_FORMATS)})'
                 }
             
-            # Get file bytes and validate as image
-            file_bytes = file.getvalue()
             if len(file_bytes) == 0:
                 return {'valid': False, 'error': 'Empty file'}
             
-            # Try to open and validate as image
+            # Try to open and validate as image (reads metadata only, no decode)
             image = Image.open(io.BytesIO(file_bytes))
             
             # Check image dimensions (reasonable limits)
@@ -81,9 +178,12 @@ class ImageProcessor:
                     'error': f'Image too small: {image.width}x{image.height} (min: 50x50)'
                 }
             
+            # Check the file structure once the cheap checks pass
+            Image.open(io.BytesIO(file_bytes)).verify()
+            
             return {
                 'valid': True,
-                'size': file.size,
+                'size': size,
                 'dimensions': f"{image.width}x{image.height}",
                 'format': image.format or 'Unknown',
                 'mode': image.mode,
@@ -96,101 +196,157 @@ class ImageProcessor:
                 'error': f'Invalid image file: {str(e)}'
             }
     
-    def process_single_image(self, image_bytes: bytes, prompt: str, filename: str) -> Dict[str, any]:
+    @backoff.on_exception(
+        backoff.expo,
+        RETRYABLE_ERRORS,
+        max_tries=MAX_API_TRIES,
+        max_time=MAX_API_RETRY_TIME,
+        jitter=backoff.full_jitter,
+        giveup=_should_give_up,
+        on_backoff=_honor_retry_after_async,
+        factor=0.5,
+        max_value=MAX_BACKOFF_WAIT,
+    )
+    async def _call_api_async(self, processed_bytes: bytes, prompt: str,
+                              semaphore: asyncio.Semaphore) -> Image.Image:
+        """Send one edit request, holding a concurrency slot per attempt"""
+        async with semaphore:
+            return await self.aclient.image_to_image(
+                processed_bytes,
+                prompt=prompt,
+                model="Qwen/Qwen-Image-Edit",
+            )
+    
+    def _check_inputs(self, image_bytes: bytes, prompt: str, filename: str) -> Optional[Dict[str, any]]:
+        """Return an error result if the inputs are unusable, otherwise None"""
+        if not isinstance(image_bytes, bytes) or len(image_bytes) == 0:
+            return {
+                'success': False,
+                'filename': filename,
+                'error': 'Invalid image data format'
+            }
+        
+        if not prompt or not prompt.strip():
+            return {
+                'success': False,
+                'filename': filename,
+                'error': 'Empty prompt'
+            }
+        
+        return None
+    
+    def _prepare_image(self, image_bytes: bytes) -> bytes:
+        """Convert the input image to the PNG bytes sent to the API"""
+        # Open image and ensure it's in RGB mode for consistency
+        image = Image.open(io.BytesIO(image_bytes))
+        
+        # RGB/grayscale PNGs within the size limit are already in the target format
+        needs_resize = max(image.size) > MAX_INPUT_EDGE
+        if image.format == 'PNG' and image.mode in ['RGB', 'L'] and not needs_resize:
+            return image_bytes
+        
+        # Convert to RGB if needed (handles RGBA, grayscale, etc.)
+        if image.mode not in ['RGB', 'L']:
+            if image.mode == 'RGBA':
+                alpha = image.getchannel('A')
+                if alpha.getextrema()[0] == 255:
+                    # Fully opaque, so just drop the alpha channel
+                    image = image.convert('RGB')
+                else:
+                    # Create white background for transparent images
+                    background = Image.new('RGB', image.size, (255, 255, 255))
+                    background.paste(image, mask=alpha)
+                    image = background
+            else:
+                image = image.convert('RGB')
+        
+        # The model works at a fixed internal resolution, so don't upload more pixels
+        if needs_resize:
+            image.thumbnail((MAX_INPUT_EDGE, MAX_INPUT_EDGE), Image.LANCZOS)
+        
+        # Save as PNG to ensure compatibility; the server re-decodes it anyway,
+        # so use the fastest deflate level
+        img_buffer = io.BytesIO()
+        image.save(img_buffer, format='PNG', optimize=False, compress_level=1)
+        return img_buffer.getvalue()
+    
+    def _encode_result(self, edited_image: Image.Image) -> bytes:
+        """Convert the edited image to bytes for storage"""
+        # Lossless WebP encodes faster and smaller than optimized PNG
+        result_buffer = io.BytesIO()
+        edited_image.save(result_buffer, format='WEBP', lossless=True, method=4)
+        return result_buffer.getvalue()
+    
+    def _build_result(self, edited_image: Image.Image, result_bytes: bytes, image_bytes: bytes, filename: str) -> Dict[str, any]:
+        """Build the success result for an edited image"""
+        return {
+            'success': True,
+            'filename': filename,
+            'image_bytes': result_bytes,
+            'preview_bytes': make_preview(result_bytes, PREVIEW_WIDTH),
+            'result_hash': hashlib.sha256(result_bytes).hexdigest(),
+            'dimensions': f"{edited_image.width}x{edited_image.height}",
+            'original_size': len(image_bytes),
+            'result_size': len(result_bytes)
+        }
+    
+    def _describe_api_error(self, api_error: Exception) -> str:
+        """Map an API exception to a user-facing error message"""
+        error_msg = str(api_error).lower()
+        
+        if 'images' in error_msg or 'parameter' in error_msg:
+            return "API parameter error - image format may be incompatible"
+        elif 'timeout' in error_msg:
+            return "Request timeout - try with a smaller image"
+        elif 'quota' in error_msg or 'rate limit' in error_msg:
+            return "API quota exceeded - please wait before trying again"
+        elif 'unauthorized' in error_msg or 'token' in error_msg:
+            return "Authentication error - check your HF_TOKEN"
+        elif 'model' in error_msg:
+            return "Model not available - try again later"
+        else:
+            return f"API error: {str(api_error)}"
+    
+    async def process_single_image_async(self, image_bytes: bytes, prompt: str, filename: str,
+                                         semaphore: asyncio.Semaphore) -> Dict[str, any]:
         """Process a single image with comprehensive error handling"""
         try:
             # Validate inputs
-            if not isinstance(image_bytes, bytes) or len(image_bytes) == 0:
-                return {
-                    'success': False,
-                    'filename': filename,
-                    'error': 'Invalid image data format'
-                }
+            invalid = self._check_inputs(image_bytes, prompt, filename)
+            if invalid:
+                return invalid
+            
+            # Reuse the result of an identical earlier request. CPU-bound steps
+            # here and below run in worker threads so in-flight requests keep going
+            cache_key = await asyncio.to_thread(_result_cache_key, image_bytes, prompt.strip())
+            cached_bytes = _get_cached_result(cache_key)
+            if cached_bytes is not None:
+                edited_image = Image.open(io.BytesIO(cached_bytes))  # Header only, for the size
+                return await asyncio.to_thread(self._build_result, edited_image, cached_bytes, image_bytes, filename)
             
-            if not prompt or not prompt.strip():
+            # Prepare image - convert to standard format
+            try:
+                processed_bytes = await asyncio.to_thread(self._prepare_image, image_bytes)
+            except Exception as e:
                 return {
                     'success': False,
                     'filename': filename,
-                    'error': 'Empty prompt'
+                    'error': f'Image preprocessing failed: {str(e)}'
                 }
             
-            # Prepare image - convert to standard format
+            # Make API call (transient failures are retried with backoff)
             try:
-                # Open image and ensure it's in RGB mode for consistency
-                image = Image.open(io.BytesIO(image_bytes))
-                
-                # Convert to RGB if needed (handles RGBA, grayscale, etc.)
-                if image.mode not in ['RGB', 'L']:
-                    if image.mode == 'RGBA':
-                        # Create white background for RGBA images
-                        background = Image.new('RGB', image.size, (255, 255, 255))
-                        background.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
-                        image = background
-                    else:
-                        image = image.convert('RGB')
-                
-                # Save as PNG to ensure compatibility
-                img_buffer = io.BytesIO()
-                image.save(img_buffer, format='PNG', optimize=True)
-                processed_bytes = img_buffer.getvalue()
-                
-            except Exception as e:
+                edited_image = await self._call_api_async(processed_bytes, prompt.strip(), semaphore)
+            except Exception as api_error:
                 return {
                     'success': False,
                     'filename': filename,
-                    'error': f'Image preprocessing failed: {str(e)}'
+                    'error': self._describe_api_error(api_error)
                 }
             
-            # Make API call with timeout and retry logic
-            max_retries = 2
-            for attempt in range(max_retries):
-                try:
-                    edited_image = self.client.image_to_image(
-                        processed_bytes,
-                        prompt=prompt.strip(),
-                        model="Qwen/Qwen-Image-Edit",
-                    )
-                    
-                    # Convert result to bytes for storage
-                    result_buffer = io.BytesIO()
-                    edited_image.save(result_buffer, format='PNG', optimize=True)
-                    result_bytes = result_buffer.getvalue()
-                    
-                    return {
-                        'success': True,
-                        'filename': filename,
-                        'image_bytes': result_bytes,
-                        'image_obj': edited_image,
-                        'original_size': len(image_bytes),
-                        'result_size': len(result_bytes)
-                    }
-                    
-                except Exception as api_error:
-                    if attempt < max_retries - 1:
-                        time.sleep(1)  # Wait before retry
-                        continue
-                    else:
-                        # Handle specific API errors
-                        error_msg = str(api_error).lower()
-                        
-                        if 'images' in error_msg or 'parameter' in error_msg:
-                            final_error = "API parameter error - image format may be incompatible"
-                        elif 'timeout' in error_msg:
-                            final_error = "Request timeout - try with a smaller image"
-                        elif 'quota' in error_msg or 'rate limit' in error_msg:
-                            final_error = "API quota exceeded - please wait before trying again"
-                        elif 'unauthorized' in error_msg or 'token' in error_msg:
-                            final_error = "Authentication error - check your HF_TOKEN"
-                        elif 'model' in error_msg:
-                            final_error = "Model not available - try again later"
-                        else:
-                            final_error = f"API error: {str(api_error)}"
-                        
-                        return {
-                            'success': False,
-                            'filename': filename,
-                            'error': final_error
-                        }
+            result_bytes = await asyncio.to_thread(self._encode_result, edited_image)
+            _store_cached_result(cache_key, result_bytes)
+            return await asyncio.to_thread(self._build_result, edited_image, result_bytes, image_bytes, filename)
             
         except Exception as e:
             return {
@@ -1,14 +1,18 @@
 import streamlit as st
 import os
+import asyncio
 from huggingface_hub import InferenceClient
-from PIL import Image
 import io
 import zipfile
 from typing import List, Dict, Optional
 import time
 import hashlib
 import traceback
-from image_processor import ImageProcessor
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from image_processor import ImageProcessor, DEFAULT_CONCURRENCY_LIMIT, THUMBNAIL_WIDTH, PREVIEW_WIDTH, make_preview
 
 # Load environment variables
 
@@ -16,6 +20,8 @@ from image_processor import ImageProcessor
 # Configuration
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB per file
 MAX_FILES = 15  # Maximum number of files
+MAX_VALIDATION_WORKERS = 8  # Threads used to hash and validate uploads
+RESULT_STORE_SIZE = 8 * MAX_FILES  # Result images kept across all sessions
 SUPPORTED_FORMATS = ['png', 'jpg', 'jpeg', 'webp']
 
 
@@ -29,29 +35,133 @@ def initialize_session_state():
         st.session_state.current_prompt = ""
     if 'processing_in_progress' not in st.session_state:
         st.session_state.processing_in_progress = False
+    if 'upload_hashes' not in st.session_state:
+        # Hashes of previously seen uploads, keyed by the uploader's per-upload file_id
+        st.session_state.upload_hashes = {}
+
+@st.cache_resource
+def get_processor() -> ImageProcessor:
+    """Shared processor so its event loop and API client (and connection pool) survive reruns"""
+    return ImageProcessor()
 
 def create_file_hash(file_content: bytes, filename: str) -> str:
     """Create unique hash for file identification"""
-    hash_input = f"{filename}_{len(file_content)}_{hashlib.md5(file_content).hexdigest()}"
-    return hashlib.sha256(hash_input.encode()).hexdigest()[:12]
+    # Single blake2b pass over the content, with the filename folded in
+    file_hash = hashlib.blake2b(filename.encode(), digest_size=6)
+    file_hash.update(b"\0")
+    file_hash.update(file_content)
+    return file_hash.hexdigest()
+
+def _validate_one(processor: ImageProcessor, file) -> Dict:
+    """Validate and hash a single upload; runs in a worker thread"""
+    # Read the upload once and share the buffer between validation and hashing
+    content = file.getvalue()
+    validation = processor.validate_image(content, file.name, file.size)
+    validation.update({'filename': file.name, 'file_id': file.file_id, 'hash': None})
+    
+    # Rejected files are never stored, so only valid ones need hashing and
+    # previews. st.image re-encodes anything it has to resize or that isn't in
+    # its output format, so render small JPEGs once here instead of every rerun
+    if validation['valid']:
+        validation['hash'] = create_file_hash(content, file.name)
+        validation['thumbnail'] = make_preview(content, THUMBNAIL_WIDTH)
+        validation['preview'] = make_preview(content, PREVIEW_WIDTH)
+    
+    return validation
+
+@st.cache_resource
+def _result_store() -> tuple:
+    """Result images live here so session state only holds their ids"""
+    # Shared by every session, so it is an LRU: results of sessions that end
+    # without clearing them are eventually evicted
+    return OrderedDict(), threading.Lock()
+
+def store_result_bytes(result: Dict) -> Dict:
+    """Move a result's image bytes into the result store, keeping its id"""
+    if result['success']:
+        rid = uuid.uuid4().hex
+        store, lock = _result_store()
+        with lock:
+            store[rid] = (result.pop('image_bytes'), result.pop('preview_bytes'))
+            while len(store) > RESULT_STORE_SIZE:
+                store.popitem(last=False)
+        result['rid'] = rid
+    return result
 
-def create_zip_download(results: List[Dict]) -> bytes:
-    """Create ZIP file containing all successful results"""
+def _get_stored_result(result: Dict) -> Optional[tuple]:
+    """Fetch a result's (image, preview) bytes from the result store, marking it recently used"""
+    store, lock = _result_store()
+    with lock:
+        stored = store.get(result.get('rid'))
+        if stored is not None:
+            store.move_to_end(result['rid'])
+        return stored
+
+def get_result_bytes(result: Dict) -> Optional[bytes]:
+    """Fetch a result's image bytes from the result store"""
+    stored = _get_stored_result(result)
+    return stored[0] if stored else None
+
+def release_results(results: List[Dict]):
+    """Drop stored images for results that are being discarded"""
+    store, lock = _result_store()
+    with lock:
+        for result in results:
+            store.pop(result.get('rid'), None)
+
+def zip_cache_key(entries: List[tuple]) -> tuple:
+    """Identify a set of results for caching their ZIP without hashing the image bytes"""
+    return tuple((result['filename'], result.get('result_hash')) for result, _ in entries)
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def create_zip_download(results_key: tuple, _entries: List[tuple]) -> bytes:
+    """Create ZIP file containing all successful results, given (result, image bytes) pairs"""
     zip_buffer = io.BytesIO()
     
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for i, result in enumerate(results):
-            if result['success']:
-                # Create filename
-                base_name = os.path.splitext(result['filename'])[0]
-                safe_name = "".join(c for c in base_name if c.isalnum() or c in (' ', '-', '_')).strip()
-                zip_filename = f"{i+1:02d}_edited_{safe_name}.png"
-                
-                # Add file to ZIP
-                zip_file.writestr(zip_filename, result['image_bytes'])
+    # Images are already compressed, so store them without deflating again
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_STORED) as zip_file:
+        for i, (result, result_bytes) in enumerate(_entries):
+            # Create filename
+            base_name = os.path.splitext(result['filename'])[0]
+            safe_name = "".join(c for c in base_name if c.isalnum() or c in (' ', '-', '_')).strip()
+            zip_filename = f"{i+1:02d}_edited_{safe_name}.webp"
+            
+            # Add file to ZIP
+            zip_file.writestr(zip_filename, result_bytes)
     
     return zip_buffer.getvalue()
 
+def _run_batch(processor: ImageProcessor, files_data: List, prompt: str,
+               concurrency_limit: int, on_result) -> List[Dict]:
+    """Process all files concurrently on the processor's loop, reporting each result as it completes"""
+    # A semaphore binds to the loop that first waits on it, so this one is
+    # owned by the processor's loop and limits only this batch
+    semaphore = asyncio.Semaphore(concurrency_limit)
+    
+    futures = {}
+    for i, (file_hash, file_data) in enumerate(files_data):
+        future = processor.submit(processor.process_single_image_async(
+            file_data['bytes'],
+            prompt,
+            file_data['filename'],
+            semaphore
+        ))
+        futures[future] = (i, file_hash)
+    
+    results = [None] * len(futures)
+    
+    # Results are collected on the script thread so on_result can update the UI
+    for completed, future in enumerate(as_completed(futures), start=1):
+        index, file_hash = futures[future]
+        result = future.result()
+        # Link the result to its upload so duplicate filenames can't mix them up
+        result['file_hash'] = file_hash
+        results[index] = result
+        on_result(result, completed)
+    
+    # Keep results in upload order regardless of completion order
+    return results
+
 def main():
     st.set_page_config(
         page_title="Batch Image Editor with Qwen",
@@ -87,12 +197,6 @@ def main():
     st.markdown('<h1 class="main-header">🎨 Batch Image Editor with Qwen</h1>', unsafe_allow_html=True)
     st.markdown("Transform multiple images simultaneously using AI-powered editing!")
     
-    # Initialize processor
-    try:
-        processor = ImageProcessor()
-    except:
-        st.stop()  # Stop if processor initialization fails
-    
     # Sidebar
     with st.sidebar:
         st.markdown("### ℹ️ Information")
@@ -119,6 +223,14 @@ def main():
             with col2:
                 st.metric("Total Size", f"{total_size/1024/1024:.1f}MB")
         
+        # Processing settings
+        st.markdown("### ⚡ Performance")
+        concurrency_limit = st.slider(
+            "Max concurrent requests",
+            1, 8, DEFAULT_CONCURRENCY_LIMIT,
+            help="Higher values finish batches faster but may hit provider rate limits"
+        )
+        
         # Control buttons
         st.markdown("### 🎛️ Controls")
         
@@ -130,14 +242,22 @@ def main():
         
         with col2:
             if st.button("🔄 Clear Results", help="Clear processing results"):
+                release_results(st.session_state.processing_results)
                 st.session_state.processing_results = []
                 st.rerun()
         
         if st.button("🆕 New Session", help="Start fresh", type="primary"):
+            release_results(st.session_state.processing_results)
             for key in ['uploaded_files_data', 'processing_results', 'current_prompt']:
                 st.session_state[key] = {} if 'data' in key or 'results' in key else ""
             st.rerun()
     
+    # Initialize processor
+    try:
+        processor = get_processor()
+    except:
+        st.stop()  # Stop if processor initialization fails
+    
     # Main content area
     col1, col2 = st.columns([1.2, 0.8])
     
@@ -166,31 +286,51 @@ def main():
             
             progress_placeholder = st.empty()
             
-            for i, file in enumerate(uploaded_files):
-                progress_placeholder.text(f"Validating files... ({i+1}/{len(uploaded_files)})")
-                
-                file_hash = create_file_hash(file.getvalue(), file.name)
-                
-                # Only process if not already in session
-                if file_hash not in st.session_state.uploaded_files_data:
-                    validation = processor.validate_image(file)
+            # Skip uploads whose hash is already in the session, so unchanged
+            # files aren't re-read and re-hashed on every rerun
+            upload_hashes = st.session_state.upload_hashes
+            pending_files = [
+                file for file in uploaded_files
+                if upload_hashes.get(file.file_id) not in st.session_state.uploaded_files_data
+            ]
+            
+            # Hashing and PIL decoding release the GIL, so validate in parallel
+            if pending_files:
+                with ThreadPoolExecutor(max_workers=min(MAX_VALIDATION_WORKERS, len(pending_files))) as executor:
+                    validations = executor.map(
+                        lambda file: _validate_one(processor, file),
+                        pending_files
+                    )
                     
-                    if validation['valid']:
-                        st.session_state.uploaded_files_data[file_hash] = {
-                            'filename': file.name,
-                            'size': validation['size'],
-                            'dimensions': validation['dimensions'],
-                            'format': validation['format'],
-                            'mode': validation['mode'],
-                            'bytes': validation['bytes'],
-                            'hash': file_hash
-                        }
-                        new_files += 1
-                    else:
-                        invalid_files.append({
-                            'filename': file.name,
-                            'error': validation['error']
-                        })
+                    for i, validation in enumerate(validations):
+                        progress_placeholder.text(f"Validating files... ({i+1}/{len(pending_files)})")
+                        
+                        file_hash = validation['hash']
+                        if validation['valid']:
+                            upload_hashes[validation['file_id']] = file_hash
+                        
+                        # Only process if not already in session
+                        if file_hash in st.session_state.uploaded_files_data:
+                            continue
+                        
+                        if validation['valid']:
+                            st.session_state.uploaded_files_data[file_hash] = {
+                                'filename': validation['filename'],
+                                'size': validation['size'],
+                                'dimensions': validation['dimensions'],
+                                'format': validation['format'],
+                                'mode': validation['mode'],
+                                'bytes': validation['bytes'],
+                                'thumbnail': validation['thumbnail'],
+                                'preview': validation['preview'],
+                                'hash': file_hash
+                            }
+                            new_files += 1
+                        else:
+                            invalid_files.append({
+                                'filename': validation['filename'],
+                                'error': validation['error']
+                            })
             
             progress_placeholder.empty()
             
@@ -217,8 +357,7 @@ def main():
                     
                     with col_preview:
                         try:
-                            image = Image.open(io.BytesIO(data['bytes']))
-                            st.image(image, width=80)
+                            st.image(data['thumbnail'], width=THUMBNAIL_WIDTH, output_format="JPEG")
                         except:
                             st.text("Preview error")
                     
@@ -271,6 +410,7 @@ def main():
         ):
             if can_process:
                 st.session_state.processing_in_progress = True
+                release_results(st.session_state.processing_results)
                 st.session_state.processing_results = []
                 
                 # Processing UI
@@ -281,27 +421,16 @@ def main():
                 files_data = list(st.session_state.uploaded_files_data.items())
                 total_files = len(files_data)
                 
-                # Process each image
-                for i, (file_hash, file_data) in enumerate(files_data):
-                    current_progress = (i + 1) / total_files
-                    status_text.text(f"Processing: {file_data['filename']} ({i+1}/{total_files})")
-                    
-                    result = processor.process_single_image(
-                        file_data['bytes'],
-                        prompt,
-                        file_data['filename']
-                    )
-                    
-                    st.session_state.processing_results.append(result)
-                    progress_bar.progress(current_progress)
-                    
-                    # Brief pause to show progress
-                    time.sleep(0.2)
+                def on_result(result: Dict, completed: int):
+                    status_text.text(f"Processed: {result['filename']} ({completed}/{total_files})")
+                    progress_bar.progress(completed / total_files)
                 
-                # Complete processing
-                status_text.text("✅ Processing completed!")
-                time.sleep(1)
+                # Process all images concurrently
+                status_text.text(f"Processing {total_files} images...")
+                results = _run_batch(processor, files_data, prompt, concurrency_limit, on_result)
+                st.session_state.processing_results.extend(store_result_bytes(result) for result in results)
                 
+                # Complete processing
                 st.session_state.processing_in_progress = False
                 status_text.empty()
                 progress_bar.empty()
@@ -347,13 +476,22 @@ def main():
             st.markdown("### 📥 Download Results")
             
             # Create download data
-            zip_data = create_zip_download(successful)
+            entries = [(result, get_result_bytes(result)) for result in successful]
+            available = [(result, result_bytes) for result, result_bytes in entries if result_bytes is not None]
+            expired = [result['filename'] for result, result_bytes in entries if result_bytes is None]
+            
+            if expired:
+                st.error(f"❌ {len(expired)} result(s) are no longer available on the server and are "
+                         f"missing from the download: {', '.join(expired)}. Run the batch again to restore them.")
+            
+            zip_data = create_zip_download(zip_cache_key(available), available)
             
             col_dl1, col_dl2 = st.columns([1, 1])
             
             with col_dl1:
                 download_btn = st.download_button(
-                    label=f"📦 Download All ({len(successful)} images)",
+                    label=f"📦 Download All ({len(available)} images)",
+                    disabled=not available,
                     data=zip_data,
                     file_name=f"batch_edited_{int(time.time())}.zip",
                     mime="application/zip",
@@ -386,39 +524,37 @@ def main():
                         with col_before:
                             st.markdown("**📷 Original**")
                             # Find original image
-                            original_data = None
-                            for file_data in st.session_state.uploaded_files_data.values():
-                                if file_data['filename'] == result['filename']:
-                                    original_data = file_data
-                                    break
+                            original_data = st.session_state.uploaded_files_data.get(result['file_hash'])
                             
                             if original_data:
                                 try:
-                                    original_image = Image.open(io.BytesIO(original_data['bytes']))
-                                    st.image(original_image, use_container_width=True)
+                                    st.image(original_data['preview'], use_container_width=True, output_format="JPEG")
                                     st.text(f"Size: {original_data['dimensions']}")
                                 except:
                                     st.error("Could not display original image")
                         
                         with col_after:
                             st.markdown("**✨ Edited**")
-                            try:
-                                st.image(result['image_obj'], use_container_width =True)
-                                edited_img = result['image_obj']
-                                st.text(f"Size: {edited_img.width}x{edited_img.height}")
-                                
-                                # Individual download
-                                img_buffer = io.BytesIO()
-                                edited_img.save(img_buffer, format='PNG')
-                                st.download_button(
-                                    f"💾 Download",
-                                    data=img_buffer.getvalue(),
-                                    file_name=f"edited_{result['filename'].split('.')[0]}.png",
-                                    mime="image/png",
-                                    key=f"download_{i}"
-                                )
-                            except:
-                                st.error("Could not display edited image")
+                            stored = _get_stored_result(result)
+                            if stored is None:
+                                st.error("Edited image is no longer available - run the batch again")
+                            else:
+                                result_bytes, preview_bytes = stored
+                                try:
+                                    # Show the JPEG preview: st.image would re-encode the WebP on every rerun
+                                    st.image(preview_bytes, use_container_width=True, output_format="JPEG")
+                                    st.text(f"Size: {result['dimensions']}")
+                                    
+                                    # Individual download (result is already WebP-encoded)
+                                    st.download_button(
+                                        f"💾 Download",
+                                        data=result_bytes,
+                                        file_name=f"edited_{result['filename'].split('.')[0]}.webp",
+                                        mime="image/webp",
+                                        key=f"download_{i}"
+                                    )
+                                except:
+                                    st.error("Could not display edited image")
                 
                 if len(successful) > preview_count:
                     st.info(f"Showing {preview_count} of {len(successful)} results. Download ZIP to get all images.")